@@ -4,12 +4,14 @@
 Supports Python 3. Should not depend on App Engine API or SDK packages.
 """
 import datetime
+import enum
 import http.client
 import socket
 import ssl
 import io
 from urllib.error import HTTPError, URLError
 import urllib.parse, urllib.request
+import uuid
 
 from flask import Flask, request
 from oauthlib.oauth2.rfc6749.errors import OAuth2Error, TokenExpiredError
@@ -75,6 +77,7 @@ class UtilTest(testutil.TestCase):
     self.assertEqual(set(), util.trim_nulls(set()))
     self.assertEqual((), util.trim_nulls(()))
     self.assertEqual({1: 0}, util.trim_nulls({1: 0}))  # numeric zero
+    self.assertEqual({1: False, 2: 0.0}, util.trim_nulls({1: False, 2: 0.0}))
 
     # lists
     self.assertEqual([{'xyz': 3}], util.trim_nulls([{'abc': None, 'xyz': 3}]))
@@ -159,6 +162,14 @@ class UtilTest(testutil.TestCase):
     ):
       self.assertEqual(expected, util.encode(input))
 
+    # nested values use the given encoding too
+    self.assertEqual([coffee.encode('utf-16')], util.encode([coffee], 'utf-16'))
+
+    # subclasses
+    class Sub(str):
+      pass
+    self.assertEqual((b'xyz',), util.encode((Sub('xyz'),)))
+
   def test_get_first(self):
     for dict, expected in (
         ({}, None),
@@ -278,6 +289,9 @@ class UtilTest(testutil.TestCase):
         ('//foo', 'http://foo'),
         ('//foo.bar/baz', 'http://foo.bar/baz'),
         ('//foo.bar/baz', 'https://foo.bar/baz'),
+        # empty ;params are dropped, like urlunparse(urlparse(...))
+        ('//foo/bar', 'http://foo/bar;'),
+        ('//foo/a;b', 'http://foo/a;b'),
       ):
       self.assertEqual(expected, util.schemeless(url))
 
@@ -291,11 +305,13 @@ class UtilTest(testutil.TestCase):
         ('http://foo', 'http://foo'),
         ('http://foo', 'http://foo#bar'),
         ('http://foo/bar?baz', 'http://foo/bar?baz#baj'),
+        ('http://foo/bar', 'http://foo/bar;#baz'),
       ):
       self.assertEqual(expected, util.fragmentless(url))
 
   def test_clean_url(self):
-    for unchanged in '', 'http://foo', 'http://foo#bar', 'http://foo?x=y&z=w':
+    for unchanged in ('', 'http://foo', 'http://foo#bar', 'http://foo?x=y&z=w',
+                      'http://foo?q=a%20b'):
       self.assertEqual(unchanged, util.clean_url(unchanged))
 
     for bad in None, 'http://foo]', 3.14, ['http://foo']:
@@ -309,6 +325,9 @@ class UtilTest(testutil.TestCase):
                                      '&source=rss----12b80d28f892---4'))
     self.assertEqual('http://foo?source=not-rss',
                      util.clean_url('http://foo?&source=not-rss'))
+    self.assertEqual('http://foo/bar', util.clean_url('http://foo/bar;'))
+    self.assertEqual('http://foo/bar',
+                     util.clean_url('http://foo/bar;?utm_source=x'))
 
   def test_quote_path(self):
     for unchanged in '', 'foo', 'http://foo', 'http://foo#bar', 'http://foo?x=y&z=w':
@@ -354,6 +373,12 @@ class UtilTest(testutil.TestCase):
                      util.dedupe_urls(['http://foo', 'http://foo/', 'http://foo'],
                                       trailing_slash=False))
 
+    self.assertEqual(['http://a/', 'https://c/', 'https://b/'],
+                     util.dedupe_urls(['http://a', 'http://b', 'http://c',
+                                       'https://c', 'https://b', 'http://b']))
+    self.assertEqual([{'url': 'https://foo/'}],
+                     util.dedupe_urls([{'url': 'http://foo'}, {'url': 'https://foo'}]))
+
   def test_tag_uri(self):
     self.assertEqual('tag:x.com:foo', util.tag_uri('x.com', 'foo'))
     self.assertEqual('tag:x.com,2013:foo',
@@ -430,6 +455,13 @@ class UtilTest(testutil.TestCase):
     self.assertEqual(['http://☕⊙.ws'],
                      util.extract_links('emoji http://☕⊙.ws domain'))
 
+  def test_iter_extract_links(self):
+    self.assertEqual([], list(util.iter_extract_links(None)))
+
+    links = util.iter_extract_links('x http://a y (http://b/c). http://a http://b/c!')
+    self.assertEqual('http://a', next(links))
+    self.assertEqual(['http://b/c'], list(links))
+
   def test_linkify(self):
     for unchanged in (
         '',
@@ -561,6 +593,14 @@ class UtilTest(testutil.TestCase):
     # no scheme, shouldn't try to strip it
     self.assertEqual('<a href="foo.com">foo.com</a>', pl('foo.com'))
 
+  def test_tokenize_links(self):
+    self.assertEqual((['http://foo.com/a'], ['x ', '). y']),
+                     util.tokenize_links('x http://foo.com/a). y'))
+    self.assertEqual((['http://b.com'], ['<a href="http://a.com">http://a.com </a> ', '']),
+                     util.tokenize_links('<a href="http://a.com">http://a.com </a> http://b.com'))
+    self.assertEqual(([], ['see x.de ok']),
+                     util.tokenize_links('see x.de ok', skip_bare_cc_tlds=True))
+
   def test_linkify_pretty(self):
     def lp(val):
       return util.linkify(val, pretty=True, max_length=6)
@@ -592,9 +632,8 @@ class UtilTest(testutil.TestCase):
       ('2012-07-23T05:54:49.0', None, 0),
       ('2012-07-23 05:54:49Z', 0, 0),
       ('2012-07-23 05:54:49.000123Z', 0, 123),
-      # TODO: currently raises ValueError since strptime %f only accepts six digit
-      # seconds. uncomment once this is fixed
-      # ('2012-07-23T05:54:49.00012300Z', 0, 123),
+      ('2012-07-23T05:54:49.00012300Z', 0, 123),
+      ('2012-7-23 5:54:49', None, 0),
       ('2012-07-23T05:54:49+0000', 0, 0),
       ('2012-07-23 05:54:49.00-0000', 0, 0),
       ('2012-07-23T05:54:49.010203+0130', 90, 10203),
@@ -608,6 +647,11 @@ class UtilTest(testutil.TestCase):
         offset = datetime.timedelta(minutes=offset)
       self.assertEqual(offset, dt.utcoffset())
 
+    for bad in ('2012-07-23T05:54:49+0175', '2012-07-23T05:54:49-24:00',
+                '2012-07-23', '2012-13-23 05:54:49', '2012-07-23 05:54:49+05'):
+      with self.assertRaises(ValueError):
+        util.parse_iso8601(bad)
+
   def test_parse_iso8601_duration(self):
     for bad in (None, '', 'bad'):
         self.assertIsNone(util.parse_iso8601_duration(bad))
@@ -675,6 +719,9 @@ class UtilTest(testutil.TestCase):
     self.assertEqual(0, util.to_utc_timestamp(datetime.datetime(1970, 1, 1)))
     self.assertEqual(1446103883.456789, util.to_utc_timestamp(
       datetime.datetime(2015, 10, 29, 7, 31, 23, 456789)))
+    self.assertEqual(1446103883.456789, util.to_utc_timestamp(
+      datetime.datetime(2015, 10, 29, 8, 31, 23, 456789, tzinfo=datetime.timezone(
+        datetime.timedelta(hours=1)))))
 
   def test_as_utc(self):
     dt = datetime.datetime(2000, 1, 1)  # naive
@@ -761,6 +808,26 @@ class UtilTest(testutil.TestCase):
     ):
       self.assertEqual(expected, util.parse_http_equiv(input))
 
+  def test_fetch_http_equiv(self):
+    refresh = '<html><head><meta http-equiv="refresh" content="0;URL=http://a"></head></html>'
+    for input, expected in (
+      ('', ''),
+      ('<html><head></head></html>', ''),
+      ('<meta http-equiv="refresh">', ''),
+      ('<meta http-equiv="content-type" content="0;URL=http://a">', ''),
+      ('<meta http-equiv=refresh content="0;URL=http://a">', 'http://a'),
+      (refresh, 'http://a'),
+      (refresh.encode(), 'http://a'),
+      (util.parse_html(refresh), 'http://a'),
+      ('<?xml version="1.0" encoding="utf-8"?>' + refresh, 'http://a'),
+      # lxml.html.fromstring returns an HtmlComment for this
+      ('</head><body><!-- <meta http-equiv="refresh" content="0;URL=http://f"> -->',
+       ''),
+      # UTF-8 bytes without a declared charset
+      ('<meta http-equiv="refresh" content="0;URL=http://ü">'.encode(), 'http://ü'),
+    ):
+      self.assertEqual(expected, util.fetch_http_equiv(input))
+
   def test_if_changed(self):
     cache = util.CacheDict()
     updates = {}
@@ -782,7 +849,11 @@ class UtilTest(testutil.TestCase):
     self.assertEqual(None, updates['x'])
 
   def test_generate_secret(self):
-    self.assertEqual(24, len(util.generate_secret()))
+    secret = util.generate_secret()
+    self.assertIsInstance(secret, bytes)
+    self.assertEqual(22, len(secret))
+    self.assertTrue(util.is_base64(secret.decode()))
+    self.assertNotEqual(secret, util.generate_secret())
 
   def test_cache_dict(self):
     data = {1: 2, 3: 4}
@@ -798,21 +869,21 @@ class UtilTest(testutil.TestCase):
     self.assert_equals(data, cd.get_multi(list(range(4))))
 
   def test_is_int(self):
-    for arg in 0, 1, -1, '0', '11', 1.0, 12345:
+    for arg in 0, 1, -1, True, '0', '11', ' -5 ', '٣', 1.0, 12345:
       self.assertTrue(util.is_int(arg), repr(arg))
-    for arg in 0.1, 3.14, '3.0', '3xyz', None, self:
+    for arg in 0.1, 3.14, float('inf'), float('nan'), '3.0', '3xyz', '²', '', None, self:
       self.assertFalse(util.is_int(arg), repr(arg))
 
   def test_is_float(self):
-    for arg in 0, 1, -1, '0', '11', 1.0, 12345, 0.1, 3.14, '3.0':
+    for arg in 0, 1, -1, False, '0', '11', 1.0, 12345, 0.1, 3.14, '3.0', '٣':
       self.assertTrue(util.is_float(arg), repr(arg))
-    for arg in '3xyz', None, self:
+    for arg in '3xyz', float('nan'), '', None, self:
       self.assertFalse(util.is_float(arg), repr(arg))
 
   def test_is_base64(self):
     for arg in '', 'asdf', '1', '1===', '_-aglzfmJyaWQtZ3lyDgsSB1R3aXR0ZXIiAXQM':
       self.assertTrue(util.is_base64(arg), repr(arg))
-    for arg in 0, 12.2, ')(,.",\'",[---', None, self:
+    for arg in 0, 12.2, ')(,.",\'",[---', 'asdf\n', None, self:
       self.assertFalse(util.is_base64(arg), repr(arg))
 
   def test_interpret_http_exception(self):
@@ -857,6 +928,11 @@ class UtilTest(testutil.TestCase):
     ex = RequestError(status=429, body=b'my body')
     self.assertEqual(('429', 'my body'), ihc(ex))
 
+    body = json_dumps({'error': {'type': 'OAuthException', 'code': 190,
+                                 'error_subcode': 460, 'message': '☕'}})
+    ex = RequestError(status=400, body=body.encode())
+    self.assertEqual(('401', body), ihc(ex))
+
     ex = tumblpy.TumblpyError('my body', error_code=429)
     self.assertEqual(('429', 'my body'), ihc(ex))
 
@@ -1053,6 +1129,14 @@ class UtilTest(testutil.TestCase):
                      ihc(prawcore.exceptions.ResponseException(
                        testutil.requests_response('foo bar', status=504))))
 
+  def test_interpret_http_exception_caches_on_exception(self):
+    ex = requests.HTTPError(response=util.Struct(status_code='400', text=json_dumps(
+      {'error': {'type': 'OAuthException', 'code': 190, 'error_subcode': 460}})))
+    self.assertEqual('401', util.interpret_http_exception(ex)[0])
+
+    ex.response = util.Struct(status_code='500', text='')
+    self.assertEqual('401', util.interpret_http_exception(ex)[0])
+
   def test_ignore_http_4xx_error(self):
     x = 0
     with util.ignore_http_4xx_error():
@@ -1165,6 +1249,15 @@ class UtilTest(testutil.TestCase):
                        util.follow_redirects('http://will/redirect',
                                              headers=headers).url)
 
+  def test_follow_redirects_with_refresh_header_extra_parts(self):
+    self.expect_requests_head('http://will/redirect',
+                              response_headers={'refresh': '5;url=http://refresh ; x=y'})
+    self.expect_requests_head('http://refresh', redirected_url='http://final')
+
+    self.mox.ReplayAll()
+    self.assert_equals('http://final',
+                       util.follow_redirects('http://will/redirect').url)
+
   def test_follow_redirects_defaults_scheme_to_http(self):
     self.expect_requests_head('http://foo/bar', redirected_url='http://final')
     self.mox.ReplayAll()
@@ -1213,6 +1306,23 @@ class UtilTest(testutil.TestCase):
     check(None, 'http://fa.ke/bad', reject='.*/bad')
     check(None, 'mailto:xyz@fa.ke')
 
+    # literal prefix approve/reject
+    check('http://fa.ke/good/1', 'http://fa.ke/good/1', approve=r'^http://fa\.ke/good/')
+    check(None, 'http://fa.ke/bad/1', reject=r'http://fa\.ke/bad/')
+    check(None, 'http://faxke/good/1', approve=r'http://fa\.ke/good/',
+          redirects=False, domain='fa.ke')
+
+    # already canonical, or close
+    for input in ('https://fa.ke/x', 'https://fa.ke/x/', 'http://fa.ke/x',
+                  'https://fa.ke/x;y', 'https://fa.ke/x;y/', 'https://fa.ke/x?y#z',
+                  'https://www.fa.ke/x'):
+      check('https://fa.ke/x', input, domain='fa.ke', redirects=False)
+    check('https://fa.ke/x/', 'https://fa.ke/x/', domain='fa.ke',
+          trailing_slash=True, redirects=False)
+    check('https://fa.ke', 'https://fa.ke/', domain='fa.ke', redirects=False)
+    check('https://fa.ke/x;y/z', 'https://fa.ke/x;y/z;w', domain='fa.ke',
+          redirects=False)
+
   def test_load_file_lines(self):
     for expected, contents in (
       ((), ''),
@@ -1254,6 +1364,8 @@ class UtilTest(testutil.TestCase):
     self.assert_equals('💯', high[2:3])
     self.assert_equals('', high[8:])
     self.assert_equals(high, high[:9])
+    self.assert_equals('💯', high[-1])
+    self.assertIsInstance(high[1:], util.WideUnicode)
     with self.assertRaises(IndexError):
       high[3]
 
@@ -1278,12 +1390,63 @@ class UtilTest(testutil.TestCase):
       self.assert_equals(obj, util.decode_oauth_state(util.encode_oauth_state(obj)))
       self.assert_equals(str, urllib.parse.unquote(util.encode_oauth_state(util.decode_oauth_state(str))))
 
+    obj = {'a': '☕ ☕', 'b': ['/&?#%+']}
+    self.assert_equals(obj, util.decode_oauth_state(util.encode_oauth_state(obj)))
+
+    # same as quote_plus(json_dumps(...)), including non-str keys, big ints, and
+    # non-ASCII, which are escaped
+    for obj in {1: 'a'}, {'a': 2**70}, {'a': '☕'}:
+      self.assert_equals(
+        urllib.parse.quote_plus(json_dumps(obj, sort_keys=True)),
+        util.encode_oauth_state(obj))
+    self.assert_equals('{"a":"\\u2615"}',
+                       urllib.parse.unquote(util.encode_oauth_state({'a': '☕'})))
+
+    # invalid UTF-8 is decoded with replacement characters, not rejected
+    self.assert_equals({'a': 'x\ufffd'}, util.decode_oauth_state('%7B%22a%22%3A%22x%FF%22%7D'))
+
+  def test_json_loads(self):
+    for input in '{"a": [1, 2.5, null, "☕"]}', b'{"a": [1, 2.5, null, "\xe2\x98\x95"]}':
+      self.assertEqual({'a': [1, 2.5, None, '☕']}, json_loads(input))
+
+    for bad in '', '{', 'nope':
+      with self.assertRaises(ValueError):
+        json_loads(bad)
+
+    # orjson handles these differently, make sure we don't use it for them
+    for input in ('{"a": 123456789012345678901234567890}',
+                  b'{"a": 123456789012345678901234567890}'):
+      self.assertEqual({'a': 123456789012345678901234567890}, json_loads(input))
+    self.assertEqual([-9223372036854775809], json_loads('[-9223372036854775809]'))
+
+    nan = json_loads('[NaN]')[0]
+    self.assertNotEqual(nan, nan)
+    self.assertEqual(float('inf'), json_loads('1e400'))
+    self.assertEqual('\ud800', json_loads('"\\ud800"'))
+
+  def test_json_dumps(self):
+    self.assertEqual('["x/y"]', json_dumps(['x/y']))
+    self.assertEqual('["\\u2615"]', json_dumps(['☕']))
+    self.assertEqual('["☕"]', json_dumps(['☕'], ensure_ascii=False))
+
+    # non-JSON types raise or go to default
+    class Color(enum.Enum):
+      RED = 1
+    id = uuid.UUID('12345678-1234-5678-1234-567812345678')
+    for bad in {1, 2}, Color.RED, id:
+      with self.assertRaises(TypeError):
+        json_dumps({'a': bad})
+
+    self.assertEqual('["x", "x"]', json_dumps([Color.RED, id], separators=(', ', ':'),
+                                            default=lambda obj: 'x'))
+
   def test_sniff_json_or_form_encoded(self):
     for expected, input in (
       ({'a': 1, 'b': 2}, '{"a":1,"b":2}'),
       ({'a': '1', 'b': '2'}, 'a=1&b=2'),
       ({'a': '1', 'b': '2'}, '&a=1&b=2&'),
       ({'a': 'x'}, 'a=x'),
+      ({'a': ['1', '2'], 'b': '3'}, 'a=1&b=3&a=2'),
       (['a', 'b'], '["a", "b"]'),
       (['a', {'b': 3}], '["a", {"b": 3}]'),
       ({}, '{}'),
@@ -1364,6 +1527,25 @@ class UtilTest(testutil.TestCase):
     for _ in range(2):
       self.assertEqual(200, util.requests_get('http://xyz').status_code)
 
+  def test_requests_get_too_big_no_content_length(self):
+    class Session:
+      def get(self, url, **kwargs):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = url
+        resp.headers['Content-Type'] = 'text/html'
+        resp.raw = io.BytesIO(self.body)
+        return resp
+
+    session = Session()
+    session.body = b'x' * (util.MAX_HTTP_RESPONSE_SIZE + 1)
+    self.assertEqual(422, util.requests_get('http://xyz', session=session).status_code)
+
+    session.body = b'abc'
+    resp = util.requests_get('http://xyz', session=session)
+    self.assertEqual(200, resp.status_code)
+    self.assertEqual('abc', resp.text)
+
   def test_requests_get_unicode_url_ValueError(self):
     """https://console.cloud.google.com/errors/CPzNwYaL3tjb9gE"""
     url = 'http://acct:abc⊙de/'
@@ -1451,6 +1633,12 @@ class UtilTest(testutil.TestCase):
       'url': 'http://xyz',
     }, util.fetch_mf2('http://xyz#b'), ignore=['debug', 'rels', 'rel-urls'])
 
+  def test_parse_mf2_id(self):
+    html = '<div id="a" class="h-entry"><p class="p-name">a <b>b</b></p></div>'
+    self.assertEqual({'name': ['a b']}, util.parse_mf2(
+      html, url='http://xyz/', id='a')['items'][0]['properties'])
+    self.assertIsNone(util.parse_mf2(html, url='http://xyz/', id='c'))
+
   def test_fetch_mf2_require_backlink_missing(self):
     html = '<html><body class="h-entry"><p class="e-content">asdf</p></body></html>'
     self.expect_requests_get('http://xyz', html).MultipleTimes()
@@ -1471,6 +1659,14 @@ class UtilTest(testutil.TestCase):
     self.assertIsNotNone(util.fetch_mf2(
       'http://xyz',require_backlink=['http://link', 'http://back']))
 
+  def test_fetch_mf2_require_backlink_non_utf8(self):
+    html = '<html><body class="h-entry"><a href="http://bäck"></a></body></html>'
+    self.expect_requests_get('http://xyz', html.encode('latin-1'),
+                             encoding='latin-1')
+    self.mox.ReplayAll()
+
+    self.assertIsNotNone(util.fetch_mf2('http://xyz', require_backlink='http://bäck'))
+
   def test_fetch_mf2_metaformats(self):
     self.expect_requests_get('http://xyz/post',
                              '<html><head><title>A ☕ post</title></head></html>')
@@ -1511,6 +1707,23 @@ class UtilTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.assertIsNone(util.fetch_mf2('http://xyz'))
 
+  def test_parse_html_reuses_builder(self):
+    a = util.parse_html('<p>a</p>')
+    b = util.parse_html('<p>b</p>')
+    self.assertIs(a.builder, b.builder)
+    self.assertEqual('a', a.p.text)
+    self.assertEqual('b', b.p.text)
+
+  def test_parse_html_response_returns_new_soup(self):
+    resp = testutil.requests_response(
+      '<html><head><meta http-equiv="refresh" content="0;URL=http://a"></head></html>',
+      content_type='text/html')
+    soup = util.parse_html(resp)
+    soup.find('meta').decompose()
+    self.assertIsNot(soup, util.parse_html(resp))
+    self.assertIsNotNone(util.parse_html(resp).find('meta'))
+    self.assertEqual('http://a', util.fetch_http_equiv(resp))
+
   def test_parse_mf2_metaformats_nothing(self):
     self.assert_equals({
       'items': [],
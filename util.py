@@ -1,11 +1,10 @@
 """Misc web-related utilities."""
-import base64
-import calendar
-import collections
 from collections.abc import Iterator
 import contextlib
 from datetime import datetime, timedelta, timezone
 from email.message import EmailMessage
+import functools
+import html
 import http.client
 import humanize
 import inspect
@@ -14,16 +13,15 @@ import mimetypes
 import numbers
 import os
 import re
+import secrets
 from smtplib import SMTP
 import socket
 import ssl
 import string
-import sys
 import threading
 import traceback
 import urllib.error, urllib.parse, urllib.request
 from urllib.parse import urljoin, urlparse
-from xml.sax import saxutils
 
 from cachetools import cached, TTLCache
 from domain2idna import domain2idna
@@ -37,6 +35,11 @@ except ImportError:
   ujson = None
   import json
 
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
 # These are used in interpret_http_exception() and is_connection_failure(). They
 # use dependencies that we may or may not have, so degrade gracefully if they're
 # not available.
@@ -105,6 +108,12 @@ try:
 except ImportError:
   bs4 = None
 
+try:
+  import lxml.etree
+  import lxml.html
+except ImportError:
+  lxml = None
+
 try:
   import mf2py
 except ImportError:
@@ -266,8 +275,12 @@ class CacheDict(dict):
   e.g. :meth:`granary.Source.get_activities_response`.
   """
   def get_multi(self, keys):
-    keys = set(keys)
-    return {k: v for k, v in list(self.items()) if k in keys}
+    if not isinstance(keys, (set, frozenset)):
+      keys = set(keys)
+    # iterate over whichever is smaller
+    if len(keys) < len(self):
+      return {k: self[k] for k in keys if k in self}
+    return {k: v for k, v in self.items() if k in keys}
 
   def set(self, key, val, **kwargs):
     self[key] = val
@@ -278,21 +291,38 @@ class CacheDict(dict):
 
 def to_xml(value):
   """Renders a dict (usually from JSON) as an XML snippet."""
+  out = []
+  _to_xml(value, out)
+  return ''.join(out)
+
+
+def _to_xml(value, out):
+  """Appends :func:`to_xml` output fragments for value to out, a list."""
   if isinstance(value, dict):
     if not value:
-      return ''
-    elems = []
+      return
+    out.append('\n')
+    start = len(out)
     for key, vals in sorted(value.items()):
       if not isinstance(vals, (list, tuple)):
-        vals = [vals]
-      elems.extend(f'<{key}>{to_xml(val)}</{key}>' for val in vals)
-    return '\n' + '\n'.join(elems) + '\n'
+        vals = (vals,)
+      for val in vals:
+        out.append(f'<{key}>')
+        _to_xml(val, out)
+        out.append(f'</{key}>\n')
+    if len(out) == start:  # only empty lists
+      out.append('\n')
   else:
-    if value is None:
-      value = ''
-    return str(value)
+    out.append('' if value is None else str(value))
+
+
+# None and empty values of these types are nulls in trim_nulls(). The checks are
+# inlined there since it runs on every node.
+_NULL_TYPES = (dict, list, tuple, str, set, frozenset)
 
 
+_TRIM_TYPES = (dict, tuple, list, set, frozenset, Iterator)
+
 def trim_nulls(value, ignore=()):
   """Recursively removes dict and list elements with None or empty values.
 
@@ -302,20 +332,30 @@ def trim_nulls(value, ignore=()):
       Transitive: ignored keys' *entire contents* are ignored and allowed to
       have nulls, all the way down!
   """
-  NULLS = (None, {}, [], (), '', set(), frozenset())
-
   if isinstance(value, dict):
-    trimmed = {k: (v if k in ignore else trim_nulls(v, ignore=ignore))
-               for k, v in value.items()}
-    return {k: v for k, v in trimmed.items() if k in ignore or v not in NULLS}
-  elif (isinstance(value, (tuple, list, set, frozenset, Iterator)) or
-        inspect.isgenerator(value)):
-    trimmed = [trim_nulls(v, ignore=ignore) for v in value]
-    ret = (v for v in trimmed if v not in NULLS)
-    if isinstance(value, Iterator) or inspect.isgenerator(value):
-      return ret
+    trimmed = {}
+    for k, v in value.items():
+      if k not in ignore:
+        if isinstance(v, _TRIM_TYPES):
+          v = trim_nulls(v, ignore=ignore)
+        if v is None or (not v and isinstance(v, _NULL_TYPES)):
+          continue
+      trimmed[k] = v
+    return trimmed
+  elif isinstance(value, _TRIM_TYPES):
+    trimmed = []
+    for v in value:
+      if isinstance(v, _TRIM_TYPES):
+        v = trim_nulls(v, ignore=ignore)
+      if v is None or (not v and isinstance(v, _NULL_TYPES)):
+        continue
+      trimmed.append(v)
+    if type(value) is list:
+      return trimmed
+    elif isinstance(value, Iterator):  # includes generators
+      return iter(trimmed)
     else:
-      return type(value)(list(ret))
+      return type(value)(trimmed)
   else:
     return value
 
@@ -327,7 +367,7 @@ def uniquify(input):
   """
   if not input:
     return []
-  return list(collections.OrderedDict([x, 0] for x in input).keys())
+  return list(dict.fromkeys(input))  # dicts preserve insertion order
 
 
 def get_list(obj, key):
@@ -338,6 +378,8 @@ def get_list(obj, key):
   returns ``[]``.
   """
   val = obj.get(key, [])
+  if type(val) is list:  # fast path for the common case
+    return val.copy()
   return (list(val) if isinstance(val, (list, tuple, set))
           else [val] if val
           else [])
@@ -378,18 +420,26 @@ def encode(obj, encoding='utf-8'):
   Returns:
     sequence or dict: obj with all unicode strings encoded
   """
-  if isinstance(obj, str):
-    return obj.encode(encoding)
-  elif isinstance(obj, tuple):
-    return tuple(encode(v) for v in obj)
-  elif isinstance(obj, list):
-    return [encode(v) for v in obj]
-  elif isinstance(obj, set):
-    return {encode(v) for v in obj}
-  elif isinstance(obj, dict):
-    return {encode(k): encode(v) for k, v in obj.items()}
-  else:
-    return obj
+  encoder = _ENCODERS.get(type(obj))
+  if encoder is None:
+    # subclass or non-collection type. resolve once, then cache it by type.
+    encoder = next((fn for cls, fn in _ENCODERS_BY_PRECEDENCE
+                    if isinstance(obj, cls)), _encode_other)
+    _ENCODERS[type(obj)] = encoder
+
+  return encoder(obj, encoding)
+
+
+_encode_other = lambda obj, encoding: obj
+_ENCODERS_BY_PRECEDENCE = (
+  (str, lambda obj, encoding: obj.encode(encoding)),
+  (tuple, lambda obj, encoding: tuple(encode(v, encoding) for v in obj)),
+  (list, lambda obj, encoding: [encode(v, encoding) for v in obj]),
+  (set, lambda obj, encoding: {encode(v, encoding) for v in obj}),
+  (dict, lambda obj, encoding: {encode(k, encoding): encode(v, encoding)
+                                for k, v in obj.items()}),
+)
+_ENCODERS = dict(_ENCODERS_BY_PRECEDENCE)
 
 
 def get_first(obj, key, default=None):
@@ -401,6 +451,8 @@ def get_first(obj, key, default=None):
   val = obj.get(key)
   if not val:
     return default
+  elif type(val) is list:  # fast path for the common case
+    return val[0]
   return val[0] if isinstance(val, (list, tuple)) else val
 
 
@@ -477,12 +529,21 @@ def parse_acct_uri(uri, hosts=None):
   return username, host
 
 
+# we split the same URLs over and over, and urlsplit's own cache is small.
+# SplitResults are immutable, so they're safe to share.
+_urlsplit = functools.lru_cache(maxsize=4096)(urllib.parse.urlsplit)
+
+
 def favicon_for_url(url):
-  return f'http://{urlparse(url).netloc}/favicon.ico'
+  return f'http://{_urlsplit(url).netloc}/favicon.ico'
 
 
 FULL_HOST_RE = re.compile(HOST_RE + '$')
 
+# stripped in order, so eg www.m.foo.com becomes foo.com
+_MINIMIZE_SUBDOMAINS = ('www.', 'mobile.', 'm.')
+
+@functools.lru_cache(maxsize=4096)
 def domain_from_link(url, minimize=True):
   """Extracts and returns the meaningful domain from a URL.
 
@@ -498,15 +559,15 @@ def domain_from_link(url, minimize=True):
     return None
 
   try:
-    parsed = urlparse(url)
+    parsed = _urlsplit(url)
     if not parsed.hostname and '//' not in url:
-      parsed = urlparse('http://' + url)
+      parsed = _urlsplit('http://' + url)
   except ValueError:
     return None
 
   domain = parsed.hostname
-  if domain and minimize:
-    for subdomain in ('www.', 'mobile.', 'm.'):
+  if domain and minimize and domain.startswith(_MINIMIZE_SUBDOMAINS):
+    for subdomain in _MINIMIZE_SUBDOMAINS:
       if domain.startswith(subdomain):
         domain = domain[len(subdomain):]
 
@@ -540,14 +601,19 @@ def domain_or_parent_in(input, domains):
     raise ValueError(f'Expected domains to be sequence, got {domains.__class__}')
   elif not input or not domains:
     return False
-  elif input in domains:
+  elif not isinstance(domains, (set, frozenset, dict)):
+    domains = set(domains)
+
+  if input in domains:
     return True
 
-  for domain in domains:
-    if not domain.startswith('.'):
-      domain = '.' + domain
-    if input.endswith(domain):
+  # look up each parent domain instead of scanning domains
+  dot = input.find('.')
+  while dot != -1:
+    parent = input[dot + 1:]
+    if parent in domains or input[dot:] in domains:
       return True
+    dot = input.find('.', dot + 1)
 
   return False
 
@@ -567,7 +633,7 @@ def update_scheme(url, request):
     str: URL
   """
   if request.scheme == 'https':
-    return urllib.parse.urlunparse((request.scheme,) + urlparse(url)[1:])
+    return urllib.parse.urlunsplit((request.scheme,) + _urlsplit(url)[1:])
   return url
 
 
@@ -582,7 +648,12 @@ def schemeless(url, slashes=True):
   Returns:
     str: URL
   """
-  url = urllib.parse.urlunparse(('',) + urlparse(url)[1:])
+  if rest := _plain_web_url_rest(url):
+    url = '//' + rest
+  else:
+    parts = _urlsplit(url)
+    url = urllib.parse.urlunsplit(
+      ('', parts[1], _drop_empty_params(parts[0], parts[2])) + parts[3:])
   if not slashes:
     url = url.strip('/')
   return url
@@ -597,9 +668,45 @@ def fragmentless(url):
   Returns:
     str: URL
   """
-  return urllib.parse.urlunparse(urlparse(url)[:5] + ('',))
+  if _plain_web_url_rest(url):
+    return url.partition('#')[0]
+  scheme, netloc, path, query, _ = _urlsplit(url)
+  return urllib.parse.urlunsplit(
+    (scheme, netloc, _drop_empty_params(scheme, path), query, ''))
+
+
+def _plain_web_url_rest(url):
+  """Returns the part of an http(s) URL after ``://``, or None.
+
+  Only returns it if ``urlunparse(urlparse(url))`` would return the URL
+  unchanged, ie it doesn't have an upper case scheme, empty query or fragment,
+  ``;`` params, control characters, non-ASCII characters, brackets, etc. Lets
+  callers slice strings instead of parsing.
+  """
+  scheme, _, rest = url.partition('://')
+  if (scheme in ('http', 'https') and rest and rest[0] not in '/?#'
+      and rest.isascii() and rest.isprintable() and '[' not in rest
+      and ']' not in rest and ';' not in rest and '?#' not in rest
+      and not rest.endswith(('?', '#'))):
+    return rest
 
 
+def _drop_empty_params(scheme, path):
+  """Removes an empty ``;`` params from the end of a :func:`urlsplit` path.
+
+  :func:`urllib.parse.urlunparse` drops them, eg ``/foo;`` becomes ``/foo``,
+  so this keeps :func:`urlsplit` callers' output the same as
+  ``urlunparse(urlparse(url))``.
+  """
+  if (path.endswith(';') and scheme in urllib.parse.uses_params
+      and path.find(';', max(path.rfind('/'), 0)) == len(path) - 1):
+    return path[:-1]
+  return path
+
+
+_UTM_PARAMS = frozenset(('utm_campaign', 'utm_content', 'utm_medium', 'utm_source',
+                         'utm_term'))
+
 def clean_url(url):
   """Removes transient query params (e.g. ``utm_*``) from a URL.
 
@@ -617,19 +724,26 @@ def clean_url(url):
   if not url:
     return url
 
-  utm_params = set(('utm_campaign', 'utm_content', 'utm_medium', 'utm_source',
-                    'utm_term'))
   try:
-    parts = list(urlparse(url))
+    parts = list(_urlsplit(url))
   except (AttributeError, TypeError, ValueError):
     return None
 
-  query = urllib.parse.unquote_plus(parts[4])
+  # fast path: most URLs don't have any params we'd remove
+  path = _drop_empty_params(parts[0], parts[2])
+  if 'utm_' not in parts[3] and 'source=' not in parts[3]:
+    if path == parts[2]:
+      return url
+    parts[2] = path
+    return urllib.parse.urlunsplit(parts)
+
+  query = urllib.parse.unquote_plus(parts[3])
   params = [(name, value) for name, value in urllib.parse.parse_qsl(query)
-            if name not in utm_params
+            if name not in _UTM_PARAMS
             and not (name == 'source' and value.startswith('rss-'))]
-  parts[4] = urllib.parse.urlencode(params)
-  return urllib.parse.urlunparse(parts)
+  parts[2] = path
+  parts[3] = urllib.parse.urlencode(params)
+  return urllib.parse.urlunsplit(parts)
 
 
 def quote_path(url):
@@ -658,7 +772,18 @@ def base_url(url):
   Args:
     url (str)
   """
-  return urljoin(url, 'x')[:-1] if url else None
+  if not url:
+    return None
+
+  if rest := _plain_web_url_rest(url):
+    # fast path: cut the path after its last slash, unless urljoin would also
+    # normalize empty or dot segments
+    host, _, path = rest.partition('#')[0].partition('?')[0].partition('/')
+    parent = path[:path.rfind('/') + 1]
+    if not any(seg in ('', '.', '..') for seg in parent.split('/')[:-1]):
+      return f'{url[:-len(rest)]}{host}/{parent}'
+
+  return urljoin(url, 'x')[:-1]
 
 
 def is_web(url):
@@ -672,11 +797,36 @@ def extract_links(text):
 
   URLs in the returned list are in the order they first appear in the text.
   """
+  return list(iter_extract_links(text))
+
+
+def _trim_link_punctuation(link):
+  """Trims trailing punctuation from a link, but allows 1 () pair."""
+  return link.rstrip('.!?,;:' if '(' in link else '.!?,;:)')
+
+
+def iter_extract_links(text):
+  """Generator version of :func:`extract_links`.
+
+  Yields unique string URLs lazily, in the order they first appear in the text,
+  without building the intermediate lists that :func:`tokenize_links` does.
+  """
   if not text:
-    return []
+    return
 
-  return uniquify(tokenize_links(text, skip_html_links=False, require_scheme=True)[0])
+  if ':/' not in text:  # every URL_RE match has a scheme
+    return
 
+  seen = set()
+  for match in URL_RE.finditer(text):
+    link = _trim_link_punctuation(match.group())
+    if link and link not in seen:
+      seen.add(link)
+      yield link
+
+
+_BARE_CC_TLD_RE = re.compile(r'[^\s%s]+\.[a-z]{2}$' % PUNCT)
+_WHITESPACE_RE = re.compile(r'\s*')
 
 def tokenize_links(text, skip_bare_cc_tlds=False, skip_html_links=True,
                    require_scheme=False):
@@ -695,43 +845,37 @@ def tokenize_links(text, skip_bare_cc_tlds=False, skip_html_links=True,
     text. Roughly equivalent to the output of :func:`re.findall` and
     :func:`re.split`, with some post-processing.
   """
+  # cheap substring checks that rule out any match before running the regexp
+  if (':/' if require_scheme else '.') not in text:
+    return [], [text]
+
   regexp = URL_RE if require_scheme else LINK_RE
-  links = regexp.findall(text)
-  splits = regexp.split(text)
+  links = []
+  splits = []
+  split_start = 0  # start of the current non-link text
+  pos = 0  # end of the previous link, kept or not
 
-  for ii in range(len(links)):
-    # trim trailing punctuation from links
-    link = links[ii]
-    jj = len(link) - 1
-    while (jj >= 0 and link[jj] in '.!?,;:)'
-           # allow 1 () pair
-           and (link[jj] != ')' or '(' not in link)):
-      jj -= 1
-      links[ii] = link[:jj + 1]
-      splits[ii + 1] = link[jj + 1:] + splits[ii + 1]
-
-    link = links[ii]
+  for match in regexp.finditer(text):
+    start = match.start()
+    link = _trim_link_punctuation(match.group())
+    end = start + len(link)
+
+    before = text[pos:start]
+    pos = end
 
     # avoid double linking by looking at preceeding 2 chars
-    if ((skip_html_links and (splits[ii].strip().endswith('="')
-                              or splits[ii].strip().endswith("='")
-                              or splits[ii + 1].strip().startswith('</a')))
+    if ((skip_html_links and (before.rstrip().endswith(('="', "='"))
+                              or text.startswith('</a', _WHITESPACE_RE.match(text, end).end())))
         # skip domains with 2-letter TLDs and no schema or path
-        or (skip_bare_cc_tlds and re.match(r'[^\s%s]+\.[a-z]{2}$' % PUNCT, link))):
-      # collapse link into before text
-      splits[ii] = splits[ii] + links[ii]
-      links[ii] = None
+        or (skip_bare_cc_tlds and _BARE_CC_TLD_RE.match(link))):
+      # leave link in the surrounding text
       continue
 
-  # clean up the output by collapsing removed links
-  ii = len(links) - 1
-  while ii >= 0:
-    if links[ii] is None:
-      splits[ii] = splits[ii] + splits[ii + 1]
-      del links[ii]
-      del splits[ii + 1]
-    ii -= 1
+    splits.append(text[split_start:start])
+    links.append(link)
+    split_start = end
 
+  splits.append(text[split_start:])
   return links, splits
 
 
@@ -827,7 +971,7 @@ def pretty_link(url, text=None, text_prefix=None, keep_host=True,
   if max_length and len(text) > max_length:
     text = text[:max_length] + '...'
 
-  escaped_text = saxutils.escape(text)
+  escaped_text = html.escape(text, quote=False)
   if text_prefix:
     escaped_text = f'{text_prefix} {escaped_text}'
   if glyphicon is not None:
@@ -846,6 +990,20 @@ def pretty_link(url, text=None, text_prefix=None, keep_host=True,
 
 
 TIMEZONE_OFFSET_RE = re.compile(r'[+-]\d{2}:?\d{2}$')
+_DATETIME_RE = re.compile(
+  r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]+))?\Z')
+
+
+@functools.lru_cache(maxsize=64)
+def _offset_timezone(offset_str):
+  """Returns a :class:`datetime.timezone` for an offset like ``+05:30``."""
+  hours = int(offset_str[1:3])
+  minutes = int(offset_str[-2:])
+  if hours > 23 or minutes > 59:
+    raise ValueError(f'Invalid time zone offset {offset_str}')
+  offset = timedelta(hours=hours, minutes=minutes)
+  return timezone(-offset if offset_str[0] == '-' else offset)
+
 
 def parse_iso8601(val):
   """Parses an ISO 8601 or RFC 3339 date/time string and returns a datetime.
@@ -871,23 +1029,23 @@ def parse_iso8601(val):
   if zone:
     offset_str = zone.group()
     val = val[:-len(offset_str)]
-    offset = (datetime.strptime(offset_str[1:].replace(':', ''), '%H%M') -
-              datetime.strptime('', ''))
-    if offset_str[0] == '-':
-      offset = -offset
-    tz = timezone(offset)
+    tz = _offset_timezone(offset_str)
   elif val[-1] == 'Z':
     val = val[:-1]
     tz = timezone.utc
 
+  # fast path for the common YYYY-MM-DD HH:MM:SS[.fff...] form. int() is much
+  # faster than strptime, and handles more than six fractional digits.
+  if match := _DATETIME_RE.match(val):
+    *fields, fraction = match.groups()
+    usecs = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    return datetime(*map(int, fields), usecs, tzinfo=tz)
+
   # fractional seconds are optional. add them if they're not already there to
   # make strptime parsing below easier.
   if '.' not in val:
     val += '.0'
 
-  # TODO: this raises ValueError if seconds has more than six decimal digits
-  # since strptime %f only accepts at most six. best fix is probably to switch
-  # to datetime.fromisoformat, which handles this but only in Python 3.11+
   return datetime.strptime(val, '%Y-%m-%d %H:%M:%S.%f').replace(tzinfo=tz)
 
 
@@ -983,14 +1141,16 @@ def maybe_timestamp_to_iso8601(input):
 
 
 def to_utc_timestamp(input):
-  """Converts a datetime to a float POSIX timestamp (seconds since epoch)."""
+  """Converts a datetime to a float POSIX timestamp (seconds since epoch).
+
+  Naive datetimes are assumed to be UTC.
+  """
   if not input:
     return None
 
-  timetuple = list(input.timetuple())
-  # timetuple() usually strips microsecond
-  timetuple[5] += input.microsecond / 1000000
-  return calendar.timegm(timetuple)
+  if input.tzinfo is None:
+    input = input.replace(tzinfo=timezone.utc)
+  return input.timestamp()
 
 
 def as_utc(input):
@@ -1078,6 +1238,9 @@ def remove_query_param(url, param):
   Returns:
     (str, str) tuple: (URL without the given param, param value)
   """
+  if '?' not in url:  # no query
+    return url, None
+
   # convert to list so we can modify later
   parsed = list(urlparse(url))
 
@@ -1124,13 +1287,14 @@ def dedupe_urls(urls, key=None, trailing_slash=True):
   """
   seen = set()
   result = []
+  http_indices = {}  # maps http URL to its index in result
 
   for obj in urls:
     url = get_url(obj, key=key)
     if not url:
       continue
 
-    p = urllib.parse.urlsplit(url)
+    p = _urlsplit(url)
 
     # normalize domain and path
     # (the hostname param is automatically lower cased, but we can't use it
@@ -1139,27 +1303,33 @@ def dedupe_urls(urls, key=None, trailing_slash=True):
     if trailing_slash and not path:
       path = '/'
 
-    norm = [p.scheme, p.netloc.lower(), path, p.query, p.fragment]
+    url = urllib.parse.urlunsplit((p.scheme, p.netloc.lower(), path, p.query,
+                                   p.fragment))
 
-    if p.scheme == 'http' and urllib.parse.urlunsplit(['https'] + norm[1:]) in result:
+    if url in seen:
       continue
-    elif p.scheme == 'https':
-      try:
-        result.remove(urllib.parse.urlunsplit(['http'] + norm[1:]))
-      except ValueError:
-        pass
 
-    url = urllib.parse.urlunsplit(norm)
-    if url not in seen:
-      seen.add(url)
-      if isinstance(obj, dict):
-        val = obj if key is None else get_first(obj, key)
-        val['url'] = url
-      else:
-        obj = url
-      result.append(obj)
+    # http and https unsplit the same way, so swap the scheme prefix directly
+    # instead of unsplitting again. prefer https, and leave None placeholders
+    # for http URLs it replaces.
+    if p.scheme == 'http':
+      if 'https' + url[4:] in seen:
+        continue
+      http_indices[url] = len(result)
+    elif p.scheme == 'https':
+      index = http_indices.pop('http' + url[5:], None)
+      if index is not None:
+        result[index] = None
+
+    seen.add(url)
+    if isinstance(obj, dict):
+      val = obj if key is None else get_first(obj, key)
+      val['url'] = url
+    else:
+      obj = url
+    result.append(obj)
 
-  return result
+  return [obj for obj in result if obj is not None]
 
 
 def encode_oauth_state(obj):
@@ -1176,7 +1346,8 @@ def encode_oauth_state(obj):
   if not isinstance(obj, dict):
     raise TypeError(f'Expected dict, got {obj.__class__}')
 
-  logger.debug(f'encoding state {obj!r}')
+  if logger.isEnabledFor(logging.DEBUG):
+    logger.debug(f'encoding state {obj!r}')
   return urllib.parse.quote_plus(json_dumps(trim_nulls(obj), sort_keys=True))
 
 
@@ -1192,7 +1363,8 @@ def decode_oauth_state(state):
   if not isinstance(state, str) and state is not None:
     raise TypeError(f'Expected str, got {state.__class__}')
 
-  logger.debug(f'decoding state {state!r}', )
+  if logger.isEnabledFor(logging.DEBUG):
+    logger.debug(f'decoding state {state!r}')
   try:
     obj = json_loads(urllib.parse.unquote_plus(state)) if state else {}
   except ValueError:
@@ -1245,20 +1417,26 @@ def if_changed(cache, updates, key, value):
 def generate_secret():
   """Generates a URL-safe random secret string.
 
-  Uses App Engine's ``os.urandom()``, which is designed to be cryptographically
-  secure: http://code.google.com/p/googleappengine/issues/detail?id=1055
-
-  Args:
-    bytes (int): length of string to generate
+  Uses :func:`secrets.token_urlsafe`, which is designed to be cryptographically
+  secure, with 16 random bytes.
 
   Returns:
-    str
+    bytes: URL-safe base64, without ``=`` padding
   """
-  return base64.urlsafe_b64encode(os.urandom(16))
+  return secrets.token_urlsafe(16).encode()
 
 
 def is_int(arg):
   """Returns True if arg can be converted to an integer, False otherwise."""
+  # fast paths for common types, to avoid raising and catching exceptions
+  type_ = type(arg)
+  if type_ is int or type_ is bool:
+    return True
+  elif type_ is float:
+    return arg.is_integer()
+  elif type_ is str and arg.isdecimal():
+    return True
+
   try:
     as_int = int(arg)
     return as_int == arg if isinstance(arg, numbers.Number) else True
@@ -1268,6 +1446,15 @@ def is_int(arg):
 
 def is_float(arg):
   """Returns True if arg can be converted to a float, False otherwise."""
+  # fast paths for common types, to avoid raising and catching exceptions
+  type_ = type(arg)
+  if type_ is float:
+    return arg == arg  # NaN != NaN
+  elif type_ is bool:
+    return True
+  elif type_ is str and arg.isdecimal():
+    return True
+
   try:
     as_float = float(arg)
     return as_float == arg if isinstance(arg, numbers.Number) else True
@@ -1275,9 +1462,12 @@ def is_float(arg):
     return False
 
 
+# deletes all URL-safe base64 characters
+_BASE64_DELETE = str.maketrans('', '', string.ascii_letters + string.digits + '_=-')
+
 def is_base64(arg):
   """Returns True if arg is a base64 encoded string, False otherwise."""
-  return isinstance(arg, str) and re.match('^[a-zA-Z0-9_=-]*$', arg)
+  return isinstance(arg, str) and not arg.translate(_BASE64_DELETE)
 
 
 def sniff_json_or_form_encoded(value):
@@ -1294,12 +1484,147 @@ def sniff_json_or_form_encoded(value):
   elif value[0] in ('{', '['):
     return json_loads(value)
   elif '=' in value:
-    return {k: v[0] if len(v) == 1 else v
-            for k, v in urllib.parse.parse_qs(value).items()}
+    pairs = urllib.parse.parse_qsl(value)
+    params = dict(pairs)
+    if len(params) == len(pairs):  # common case, no repeated params
+      return params
+
+    params = {}
+    for k, v in pairs:
+      params.setdefault(k, []).append(v)
+    return {k: v[0] if len(v) == 1 else v for k, v in params.items()}
   else:
     return json_loads(value)
 
 
+def _interpret_urllib_http_error(e):
+  code = e.code
+  body = None
+  try:
+    body = e.read() or e.body
+    if body:
+      # store a copy inside the exception because e.fp.seek(0) to reset isn't
+      # always available.
+      e.body = body
+      body = body.decode('utf-8')
+  except (AttributeError, KeyError):
+    if not body:
+      body = str(e.reason)
+
+  # yes, flickr returns 400s when they're down. kinda ridiculous. fix that.
+  if (code == '418' or
+      (code == '400' and
+       'Sorry, the Flickr API service is not currently available' in body)):
+    code = '504'
+
+  return code, body
+
+
+def _interpret_response_error(e):
+  # TODO: this (and same below) can raise if the body was already read:
+  # 'RuntimeError: The content for this response was already consumed'
+  # https://console.cloud.google.com/errors/detail/CKuWp8f18s3g0gE;time=P30D?project=brid-gy
+  return e.response.status_code, e.response.text
+
+
+def _interpret_oauth_refresh_error(e):
+  code = None
+  body = str(e)
+  if body.startswith('invalid_grant'):
+    code = '401'
+  elif body.startswith('internal_failure'):
+    code = '502'
+  return code, body
+
+
+# Facebook OAuthException messages that mean the user's token is no longer valid.
+# Have to use message, not error code, since some error codes are for both auth
+# and non-auth errors, e.g. we've gotten code 100 for both "This authorization
+# code has expired." and "Too many IDs. ..."
+_FACEBOOK_OAUTH_ERROR_RE = re.compile('|'.join(re.escape(msg) for msg in (
+  'token provided is invalid.',
+  'authorization code has expired.',
+  'the user is not a confirmed user.',
+  'user must be an administrator of the page',
+  'user is enrolled in a blocking, logged-in checkpoint',
+  'access token belongs to a Page that has been deleted.',
+  # this one below comes with HTTP 400, but actually seems to be transient.
+  # 'Cannot call API on behalf of this user',
+)))
+
+# (code, error_subcode) pairs that mean the user's token is no longer valid.
+# https://developers.facebook.com/docs/graph-api/using-graph-api#errorcodes
+# https://developers.facebook.com/docs/graph-api/using-graph-api#errorsubcodes
+_FACEBOOK_OAUTH_ERROR_CODES = frozenset(
+  (code, subcode) for code in (102, 190)
+  for subcode in (458, 459, 460, 463, 467, 490))
+
+# Facebook rate limiting. They've used both spellings.
+_FACEBOOK_PAGE_LIMIT_RE = re.compile('Page request limit(?:ed)? reached')
+
+# response body substrings that mean the user's account or token is gone.
+_AUTH_FAILURE_BODY_RE = re.compile('|'.join((
+  'OAuthAccessTokenException',       # Instagram: revoked access
+  'APIRequiresAuthenticationError',  # Instagram: account deleted
+  'AUTHENTICATION_FAILED',           # Sharkey
+)))
+
+_HTTP_EXCEPTION_HANDLERS = {
+  urllib.error.HTTPError: _interpret_urllib_http_error,
+  urllib.error.URLError: lambda e: (None, str(e.reason)),
+}
+"""Maps exception class to function that takes an exception and returns
+(code, body). Only includes classes from dependencies that are installed.
+Used in :func:`interpret_http_exception`, which looks up each class in the
+exception's MRO.
+"""
+if exc:
+  _HTTP_EXCEPTION_HANDLERS[exc.WSGIHTTPException] = \
+    lambda e: (e.code, e.plain_body({}))
+
+if werkzeug:
+  _HTTP_EXCEPTION_HANDLERS[werkzeug.exceptions.HTTPException] = \
+    lambda e: (e.code, e.get_description())
+
+if requests:
+  _HTTP_EXCEPTION_HANDLERS[requests.HTTPError] = _interpret_response_error
+
+if prawcore:
+  _HTTP_EXCEPTION_HANDLERS.update({
+    prawcore.exceptions.ResponseException: _interpret_response_error,
+    prawcore.exceptions.OAuthException: _interpret_oauth_refresh_error,
+  })
+
+if tumblpy:
+  _HTTP_EXCEPTION_HANDLERS[tumblpy.TumblpyError] = lambda e: (e.error_code, e.msg)
+
+if tweepy:
+  _HTTP_EXCEPTION_HANDLERS[tweepy.HTTPException] = lambda e: (
+    '429' if isinstance(e, tweepy.TooManyRequests) else '400', e.response.text)
+
+if apiclient:
+  _HTTP_EXCEPTION_HANDLERS[apiclient.errors.HttpError] = \
+    lambda e: (e.resp.status, e.response.text)
+
+if AccessTokenRefreshError:
+  _HTTP_EXCEPTION_HANDLERS[AccessTokenRefreshError] = _interpret_oauth_refresh_error
+
+if OAuth2Error:
+  _HTTP_EXCEPTION_HANDLERS[OAuth2Error] = lambda e: (e.status_code, str(e))
+
+if websockets:
+  _HTTP_EXCEPTION_HANDLERS.update({
+    InvalidStatus: lambda e: (str(e.response.status_code),
+                              e.response.body.decode()),
+    InvalidStatusCode: lambda e: (str(e.status_code), ''),
+    ConnectionClosedError: lambda e: ('502', str(e)),
+  })
+
+# websockets exceptions that interpret_http_exception treats as HTTP errors, not
+# connection failures. empty if websockets isn't installed.
+_WEBSOCKETS_HTTP_ERRORS = (InvalidStatus, InvalidStatusCode) if websockets else ()
+
+
 def interpret_http_exception(exception):
   """Extracts the status code and response from different HTTP exception types.
 
@@ -1315,100 +1640,39 @@ def interpret_http_exception(exception):
       * :class:`urllib.error.URLError`
       * :class:`werkzeug.exceptions.HTTPException`
 
+  The result is cached on the exception, so repeated calls, eg from
+  :func:`ignore_http_4xx_error` and then the caller, don't re-parse the body.
+
   Returns:
     (str status code or ``None``, str response body or ``None``)
   """
   e = exception
-  code = body = None
-
-  if exc and isinstance(e, exc.WSGIHTTPException):
-    code = e.code
-    body = e.plain_body({})
+  if cached := getattr(e, '_webutil_interpreted', None):
+    return cached
 
-  elif werkzeug and isinstance(e, werkzeug.exceptions.HTTPException):
-    code = e.code
-    body = e.get_description()
+  code = body = None
 
-  elif isinstance(e, urllib.error.HTTPError):
-    code = e.code
-    try:
-      body = e.read() or e.body
-      if body:
-        # store a copy inside the exception because e.fp.seek(0) to reset isn't
-        # always available.
-        e.body = body
-        body = body.decode('utf-8')
-    except (AttributeError, KeyError):
-      if not body:
-        body = str(e.reason)
-
-    # yes, flickr returns 400s when they're down. kinda ridiculous. fix that.
-    if (code == '418' or
-        (code == '400' and
-         'Sorry, the Flickr API service is not currently available' in body)):
-      code = '504'
-
-  elif isinstance(e, urllib.error.URLError):
-    body = str(e.reason)
-
-  elif ((requests and isinstance(e, requests.HTTPError)) or
-        (prawcore and isinstance(e, prawcore.exceptions.ResponseException))):
-    code = e.response.status_code
-    # TODO: this (and same below) can raise if the body was already read:
-    # 'RuntimeError: The content for this response was already consumed'
-    # https://console.cloud.google.com/errors/detail/CKuWp8f18s3g0gE;time=P30D?project=brid-gy
-    body = e.response.text
-
-  elif tumblpy and isinstance(e, tumblpy.TumblpyError):
-    code = e.error_code
-    body = e.msg
-
-  elif tweepy and isinstance(e, tweepy.HTTPException):
-    code = '429' if isinstance(e, tweepy.TooManyRequests) else '400'
-    body = e.response.text
-
-  elif apiclient and isinstance(e, apiclient.errors.HttpError):
-    code = e.resp.status
-    body = e.response.text
-
-  elif ((AccessTokenRefreshError and isinstance(e, AccessTokenRefreshError)) or
-        (prawcore and isinstance(e, prawcore.exceptions.OAuthException))):
-    body = str(e)
-    if body.startswith('invalid_grant'):
+  for cls in e.__class__.__mro__:
+    if handler := _HTTP_EXCEPTION_HANDLERS.get(cls):
+      code, body = handler(e)
+      break
+  else:
+    # hack to interpret gdata.client.RequestError since gdata isn't a dependency
+    if e.__class__.__name__ == 'RequestError':
+      code = getattr(e, 'status')
+      body = getattr(e, 'body')
+    elif e.__class__.__name__ == 'Unauthorized':
       code = '401'
-    elif body.startswith('internal_failure'):
-      code = '502'
-
-  elif OAuth2Error and isinstance(e, OAuth2Error):
-    code = e.status_code
-    body = str(e)
-
-  elif websockets and isinstance(e, InvalidStatus):
-    code = str(e.response.status_code)
-    body = e.response.body.decode()
-
-  elif websockets and isinstance(e, InvalidStatusCode):
-    code = str(e.status_code)
-    body = ''
-
-  elif websockets and isinstance(e, ConnectionClosedError):
-    code = '502'
-    body = str(e)
-
-  # hack to interpret gdata.client.RequestError since gdata isn't a dependency
-  elif e.__class__.__name__ == 'RequestError':
-    code = getattr(e, 'status')
-    body = getattr(e, 'body')
-  elif e.__class__.__name__ == 'Unauthorized':
-    code = '401'
-    body = ''
+      body = ''
 
   if code:
     code = str(code)
   orig_code = code
-  if code or body:
+  if (code or body) and logger.isEnabledFor(logging.WARNING):
     logger.warning(f'Error {code}, response body: {body!r}')
 
+  # JSON parsers take bytes directly, so parse the raw body below
+  raw_body = body
   if isinstance(body, bytes):
     # good faith effort to decode as UTF-8 or ASCII
     try:
@@ -1416,28 +1680,24 @@ def interpret_http_exception(exception):
     except:
       pass
 
-  # silo-specific error_types that should disable the source.
-  #
-  # instagram
-  if body and ('OAuthAccessTokenException' in body or      # revoked access
-               'APIRequiresAuthenticationError' in body):  # account deleted
-    code = '401'
-
+  # silo-specific error_types that should disable the source, eg Instagram,
   # Sharkey
-  if body and 'AUTHENTICATION_FAILED' in body:
+  if body and isinstance(body, str) and _AUTH_FAILURE_BODY_RE.search(body):
     code = '401'
 
   # facebook and others
   # https://developers.facebook.com/docs/graph-api/using-graph-api/#errors
   body_json = None
   error = {}
-  if body:
+  # only JSON objects and strings can hold an error, so don't bother parsing
+  # HTML, plain text, etc
+  if isinstance(body, str) and body.lstrip()[:1] in ('{', '"'):
     try:
-      body_json = json_loads(body)
+      body_json = json_loads(raw_body)
       error = body_json if isinstance(body_json, str) else body_json.get('error', {})
       if not isinstance(error, dict):
         error = {'message': repr(error)}
-    except BaseException:
+    except (ValueError, AttributeError):
       pass
 
   # twitter
@@ -1454,23 +1714,11 @@ def interpret_http_exception(exception):
   err_code = error.get('code')
   err_subcode = error.get('error_subcode')
   if ((type == 'OAuthException' and
-       # have to use message, not error code, since some error codes are for
-       # both auth and non-auth errors, e.g. we've gotten code 100 for both
-       # "This authorization code has expired." and "Too many IDs. ..."
-       ('token provided is invalid.' in message or
-        'authorization code has expired.' in message or
-        'the user is not a confirmed user.' in message or
-        'user must be an administrator of the page' in message or
-        'user is enrolled in a blocking, logged-in checkpoint' in message or
-        'access token belongs to a Page that has been deleted.' in message or
-        # this one below comes with HTTP 400, but actually seems to be transient.
-        # 'Cannot call API on behalf of this user' in message or
-        'Permissions error' == message
-      )) or
+       (_FACEBOOK_OAUTH_ERROR_RE.search(message) or
+        'Permissions error' == message)) or
       (type == 'FacebookApiException' and 'Permissions error' in message) or
-      # https://developers.facebook.com/docs/graph-api/using-graph-api#errorcodes
-      # https://developers.facebook.com/docs/graph-api/using-graph-api#errorsubcodes
-      (err_code in (102, 190) and err_subcode in (458, 459, 460, 463, 467, 490)) or
+      (isinstance(err_code, int) and isinstance(err_subcode, int) and
+       (err_code, err_subcode) in _FACEBOOK_OAUTH_ERROR_CODES) or
       (err_code == 326 and 'this account is temporarily locked' in message)
     ):
     code = '401'
@@ -1482,8 +1730,7 @@ def interpret_http_exception(exception):
       code = '503'
 
   if (code == '400' and type == 'OAuthException' and
-      ('Page request limit reached' in message or
-       'Page request limited reached' in message)):
+      _FACEBOOK_PAGE_LIMIT_RE.search(message)):
     code = '429'
 
   # upstream errors and connection failures become 502s and 504s, respectively
@@ -1492,8 +1739,7 @@ def interpret_http_exception(exception):
   elif (is_connection_failure(e)
           # websockets exceptions. InvalidHandshake is a connection failure, but
           # these are subclasses of InvalidHandshake and are HTTP-level errors)
-          and not isinstance(e, InvalidStatus)
-          and not isinstance(e, InvalidStatusCode)):
+          and not isinstance(e, _WEBSOCKETS_HTTP_ERRORS)):
     code = '504'
     if not body:
       body = str(e)
@@ -1501,6 +1747,11 @@ def interpret_http_exception(exception):
   if orig_code != code:
     logger.info(f'Converting code {orig_code} to {code}')
 
+  try:
+    e._webutil_interpreted = code, body
+  except AttributeError:  # eg exceptions with __slots__
+    pass
+
   return code, body
 
 
@@ -1514,58 +1765,65 @@ def ignore_http_4xx_error():
       raise
 
 
+_CONN_FAIL_TYPES = [
+  ConnectionError,
+  http.client.ImproperConnectionState,
+  http.client.IncompleteRead,
+  http.client.NotConnected,
+  socket.gaierror,
+  socket.herror,
+  socket.timeout,
+  TimeoutError,
+  ssl.SSLError,
+]
+if prawcore:
+  _CONN_FAIL_TYPES += [
+    prawcore.exceptions.RequestException,
+  ]
+
+if requests:
+  _CONN_FAIL_TYPES += [
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError,
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.TooManyRedirects,
+  ]
+
+if urllib3:
+  _CONN_FAIL_TYPES += [
+    urllib3.exceptions.HTTPError,
+    urllib3.exceptions.ReadTimeoutError,
+  ]
+
+if websockets:
+  _CONN_FAIL_TYPES += [
+    InvalidHandshake,
+    ProtocolError,
+  ]
+
+_CONN_FAIL_TYPES = tuple(_CONN_FAIL_TYPES)
+
+# these are tweepy.TweepError wrapping NewConnectionError
+_CONN_FAIL_RE = re.compile(r'Connection closed unexpectedly|Max retries exceeded')
+
 def is_connection_failure(exception):
   """Returns True if the given exception is a network connection failure.
 
   ...False otherwise.
   """
-  types = [
-      ConnectionError,
-      http.client.ImproperConnectionState,
-      http.client.IncompleteRead,
-      http.client.NotConnected,
-      prawcore.exceptions.RequestException,
-      socket.gaierror,
-      socket.herror,
-      socket.timeout,
-      TimeoutError,
-      ssl.SSLError,
-  ]
-  if requests:
-    types += [
-      requests.exceptions.ChunkedEncodingError,
-      requests.exceptions.ContentDecodingError,
-      requests.ConnectionError,
-      requests.Timeout,
-      requests.TooManyRedirects,
-    ]
-
-  if urllib3:
-    types += [
-      urllib3.exceptions.HTTPError,
-      urllib3.exceptions.ReadTimeoutError,
-    ]
-
-  if websockets:
-    types += [
-      InvalidHandshake,
-      ProtocolError,
-    ]
-
-  msg = str(exception)
-  if (isinstance(exception, tuple(types)) or
-      (isinstance(exception, urllib.error.URLError) and
-       isinstance(exception.reason, socket.error)) or
-      (isinstance(exception, http.client.HTTPException) and
-       'Deadline exceeded' in msg) or
-      # these are tweepy.TweepError wrapping NewConnectionError
-      'Connection closed unexpectedly' in msg or
-      'Max retries exceeded' in msg
-     ):
-    logger.info(f'Connection failure: {exception}', stack_info=False)
-    return True
+  if not (isinstance(exception, _CONN_FAIL_TYPES) or
+          (isinstance(exception, urllib.error.URLError) and
+           isinstance(exception.reason, socket.error))):
+    # only stringify if the type checks above didn't match
+    msg = str(exception)
+    if not ((isinstance(exception, http.client.HTTPException) and
+             'Deadline exceeded' in msg) or
+            _CONN_FAIL_RE.search(msg)):
+      return False
 
-  return False
+  logger.info(f'Connection failure: {exception}', stack_info=False)
+  return True
 
 
 class FileLimiter(object):
@@ -1577,21 +1835,24 @@ class FileLimiter(object):
     self.read_limit = read_limit
     self.amount_seen = 0
     self.file_obj = file_obj
+    self._read = file_obj.read
     self.ateof = False
 
     # So that requests doesn't try to chunk an upload but will instead stream it
     self.len = read_limit
 
   def read(self, amount=-1):
-    if self.amount_seen >= self.read_limit:
+    remaining = self.read_limit - self.amount_seen
+    if remaining <= 0:
       return b''
 
-    remaining = self.read_limit - self.amount_seen
-    to_read = remaining if amount < 0 else min(amount, remaining)
-    data = self.file_obj.read(to_read)
+    to_read = remaining if amount < 0 or amount > remaining else amount
+    data = self._read(to_read)
 
-    self.amount_seen += len(data)
-    if (len(data) < to_read) or (to_read and not data):
+    num_read = len(data)
+    self.amount_seen += num_read
+    # this also covers to_read > 0 and no data
+    if num_read < to_read:
       self.ateof = True
     return data
 
@@ -1615,18 +1876,33 @@ def load_file_lines(file):
   Returns:
     set of str
   """
-  items = set()
-
-  for line in file:
-    val = line.strip()
-    if val and not val.startswith('#'):
-      items.add(val)
+  return {val for val in (line.strip() for line in file)
+          if val and val[0] != '#'}
 
-  return items
 
+# orjson parses integers outside the 64-bit range as floats, losing precision.
+# 19 digits is conservative, since it includes some that fit.
+_LONG_NUMBER_RE = re.compile('[0-9]{19}')
+_LONG_NUMBER_BYTES_RE = re.compile(b'[0-9]{19}')
 
 def json_loads(*args, **kwargs):
-  """Wrapper around :func:`json.loads` that centralizes our JSON handling."""
+  """Wrapper around :func:`json.loads` that centralizes our JSON handling.
+
+  Uses orjson if it's installed and no extra kwargs are provided. Falls back to
+  ujson or :mod:`json` for input orjson rejects but they accept, eg ``NaN``,
+  ``1e400``, or lone surrogates, and for input with long numbers, since orjson
+  converts integers beyond 64 bits to floats.
+  """
+  if orjson and len(args) == 1 and not kwargs:
+    input = args[0]
+    long_number_re = (_LONG_NUMBER_RE if isinstance(input, str)
+                      else _LONG_NUMBER_BYTES_RE)
+    if not long_number_re.search(input):
+      try:
+        return orjson.loads(input)
+      except orjson.JSONDecodeError:
+        pass
+
   return json.loads(*args, **kwargs)
 
 
@@ -1657,7 +1933,7 @@ def urlopen(url_or_req, *args, **kwargs):
   if isinstance(data, str):
     kwargs['data'] = data.encode()
 
-  if url_or_req.__class__.__name__ == 'Request':
+  if isinstance(url_or_req, urllib.request.Request):
     req = url_or_req
     if data is None:
       data = req.data
@@ -1673,11 +1949,25 @@ def urlopen(url_or_req, *args, **kwargs):
     req.add_header('User-Agent', user_agent)
 
   method = 'GET' if data is None else 'POST'
-  logger.info(f'urlopen {method} {url} {_prune(kwargs)}')
+  if logger.isEnabledFor(logging.INFO):
+    logger.info(f'urlopen {method} {url} {_prune(kwargs)}')
   kwargs.setdefault('timeout', HTTP_TIMEOUT)
   return urllib.request.urlopen(req, *args, **kwargs)
 
 
+def _netloc(url):
+  """Returns the netloc of a URL with a scheme, like urlsplit, but faster."""
+  rest = url.partition('://')[2]
+  for sep in '/?#':
+    rest = rest.partition(sep)[0]
+  return rest
+
+
+# IDNA conversion is pure Python and slow, and we often see the same URLs
+# repeatedly, eg when polling feeds
+_domain2idna = functools.lru_cache(maxsize=1024)(domain2idna)
+
+
 def requests_fn(fn):
   """Wraps ``requests.*`` and logs the HTTP method and URL.
 
@@ -1698,7 +1988,8 @@ def requests_fn(fn):
       (HTTP 502).
   """
   def call(url, session=None, *args, **kwargs):
-    logger.info(f'{"requests_cache" if session else "requests"}.{fn} {url} {_prune(kwargs)}')
+    if logger.isEnabledFor(logging.INFO):
+      logger.info(f'{"requests_cache" if session else "requests"}.{fn} {url} {_prune(kwargs)}')
 
     gateway = kwargs.pop('gateway', None)
     kwargs.setdefault('timeout', HTTP_TIMEOUT)
@@ -1723,15 +2014,15 @@ def requests_fn(fn):
 
     except (ValueError, requests.URLRequired) as e:
       if isinstance(e, requests.exceptions.InvalidURL):
-        punycode = domain2idna(url)  # surprisingly, this handles full URLs fine
+        punycode = _domain2idna(url)  # surprisingly, this handles full URLs fine
         if punycode != url:
           # the domain is valid idn2003 but not idn2008. encode and try again.
           # https://unicode.org/faq/idn.html#6
           # https://github.com/psf/requests/issues/3687
           # https://github.com/kjd/idna/issues/18
           # https://github.com/kjd/idna/issues/40
-          punycode_domain = urlparse(punycode).netloc
-          domain = urlparse(url).netloc
+          punycode_domain = _netloc(punycode)
+          domain = _netloc(url)
           kwargs['headers']['Host'] = punycode_domain
           resp = call(punycode, session=session, *args, **kwargs)
           resp.url = resp.url.replace(punycode_domain, domain)
@@ -1740,10 +2031,11 @@ def requests_fn(fn):
       if gateway:
         msg = f'Bad URL {url} : {e}'
         logger.warning(msg)
-        # this format_exc with tb None below, instead of passing exc_info=True
-        # above, prevents the 'Traceback (most recent call last):' prefix that
-        # triggers Stackdriver Error Reporting
-        logger.warning('\n'.join(traceback.format_tb(sys.exc_info()[2])))
+        # this format_tb, instead of passing exc_info=True above or using
+        # format_exc, prevents the 'Traceback (most recent call last):' prefix
+        # that triggers Stackdriver Error Reporting
+        if logger.isEnabledFor(logging.WARNING):
+          logger.warning('\n'.join(traceback.format_tb(e.__traceback__)))
         abort(400, msg)
       raise
 
@@ -1753,7 +2045,8 @@ def requests_fn(fn):
         if e.response is not None:
           msg += f' ; {e.response.text[:500]}'
         logger.warning(msg)
-        logger.debug('\n'.join(traceback.format_tb(sys.exc_info()[2])))
+        if logger.isEnabledFor(logging.DEBUG):
+          logger.debug('\n'.join(traceback.format_tb(e.__traceback__)))
         abort(502, msg)
       raise
 
@@ -1766,8 +2059,19 @@ def requests_fn(fn):
       length = resp.headers.get('Content-Length')
       if is_int(length):
         length = int(length)
+      elif kwargs.get('stream') and resp.raw is not None:
+        # no Content-Length, eg chunked. read incrementally so that we can stop
+        # early on an oversized body instead of downloading all of it
+        body = bytearray()
+        for chunk in resp.iter_content(chunk_size=65536):
+          body += chunk
+          if len(body) > MAX_HTTP_RESPONSE_SIZE:
+            break
+        length = len(body)
+        # iter_content consumed the stream, so store the body for resp.content
+        resp._content = bytes(body)
       else:
-        length = len(resp.text)
+        length = len(resp.content or b'')
       if length > MAX_HTTP_RESPONSE_SIZE:
         resp.close()
         resp.status_code = HTTP_RESPONSE_TOO_BIG_STATUS_CODE
@@ -1811,14 +2115,19 @@ def requests_post_with_redirects(url, *args, **kwargs):
   raise requests.TooManyRedirects(response=resp)
 
 
+_PRUNE_KWARGS = frozenset(('allow_redirects', 'auth', 'gateway', 'headers',
+                           'stream', 'timeout'))
+
 def _prune(kwargs):
-  return {
-    k: v for k, v in list(kwargs.items())
-    if k is not None and k not in ('allow_redirects', 'auth', 'gateway', 'headers',
-                                   'stream', 'timeout')
-  }
+  if not kwargs:
+    return kwargs
+  return {k: v for k, v in kwargs.items()
+          if k is not None and k not in _PRUNE_KWARGS}
 
 
+# url= part of a Refresh header, eg '0; url=http://foo'
+_REFRESH_URL_RE = re.compile(r'(?:^|;)\s*url=([^;]*)')
+
 @cached(follow_redirects_cache, lock=follow_redirects_cache_lock,
         key=lambda url, **kwargs: url)
 def follow_redirects(url, **kwargs):
@@ -1841,8 +2150,8 @@ def follow_redirects(url, **kwargs):
   """
   try:
     # default scheme to http
-    parsed = urlparse(url)
-    if not parsed.scheme:
+    if (not url.startswith(('http://', 'https://'))
+        and not _urlsplit(url).scheme):
       url = 'http://' + url
     resolved = requests_head(url, allow_redirects=True, **kwargs)
   except AssertionError:
@@ -1868,10 +2177,8 @@ def follow_redirects(url, **kwargs):
       resolved.headers['content-type'] = type or 'text/html'
 
   refresh = resolved.headers.get('refresh')
-  if refresh:
-    for part in refresh.split(';'):
-      if part.strip().startswith('url='):
-        return follow_redirects(part.strip()[4:], **kwargs)
+  if refresh and (match := _REFRESH_URL_RE.search(refresh)):
+    return follow_redirects(match.group(1).strip(), **kwargs)
 
   resolved.url = clean_url(resolved.url)
   if url != resolved.url:
@@ -1881,6 +2188,15 @@ def follow_redirects(url, **kwargs):
   return resolved
 
 
+# matches regexps that are just an optionally anchored literal prefix, e.g.
+# ``^https://foo\.com/``. group 1 is the prefix, still escaped.
+_LITERAL_PREFIX_RE = re.compile(r'\^?((?:[^\\.^$*+?{}\[\]|()]|\\[^\w])*)\Z')
+_REGEXP_ESCAPE_RE = re.compile(r'\\(.)')
+
+# if a URL's path contains any of these, urlparse/urlunparse might change it
+_NONCANONICAL_PATH_RE = re.compile(r'[?#;\s\x00-\x1f]')
+
+
 class UrlCanonicalizer(object):
   """Converts URLs to their canonical form.
 
@@ -1924,9 +2240,51 @@ class UrlCanonicalizer(object):
     self.redirects = redirects
     self.headers = headers
 
+    self._approve = self._matcher(approve)
+    self._reject = self._matcher(reject)
+    self._domain_suffix = f'.{self.domain}' if self.domain else None
+
+    # URLs that start with this, and don't have anything else we'd strip or
+    # change, are already canonical, so we can skip parsing them
+    self._canonical_prefix = None
+    if (self.scheme and self.domain and self.domain == self.domain.lower()
+        and not self.domain.startswith('www.')):
+      host = self.domain
+      if self.subdomain and host.count('.') == 1:
+        host = f'{self.subdomain}.{host}'
+      self._canonical_prefix = f'{self.scheme}://{host}/'
+
   @staticmethod
   def to_unicode(val):
-    return val.decode() if isinstance(val, bytes) else val
+    return val if type(val) is str else (
+      val.decode() if isinstance(val, bytes) else val)
+
+  @staticmethod
+  def _matcher(regexp):
+    """Returns a function that matches a string URL against regexp, or None.
+
+    If regexp is just a literal prefix, the function uses
+    :meth:`str.startswith` instead of the regexp engine.
+    """
+    if not regexp:
+      return None
+
+    if isinstance(regexp, str):
+      if literal := _LITERAL_PREFIX_RE.match(regexp):
+        prefix = _REGEXP_ESCAPE_RE.sub(r'\1', literal.group(1))
+        return lambda url: url.startswith(prefix)
+
+    return re.compile(regexp).match
+
+  def _is_canonical(self, url):
+    """Returns True if url is definitely already canonical, modulo redirects.
+
+    False means it may or may not be.
+    """
+    prefix = self._canonical_prefix
+    return bool(prefix and url.startswith(prefix)
+                and not _NONCANONICAL_PATH_RE.search(url, len(prefix))
+                and url.endswith('/') == bool(self.trailing_slash))
 
   def __call__(self, url, redirects=None):
     """Canonicalizes a string URL.
@@ -1935,45 +2293,56 @@ class UrlCanonicalizer(object):
     canonicalized, eg its domain doesn't match.
     """
     url = self.to_unicode(url)
-    if self.approve and self.approve.match(url):
-      return url
-    elif self.reject and self.reject.match(url):
-      return None
-
-    parsed = urlparse(url)
-    domain = parsed.hostname
-    if not domain:
-      return None
-    elif (self.domain and domain != self.domain
-          and not domain.endswith('.' + self.domain)):
-      return None
-    if domain.startswith('www.'):
-      domain = domain[4:]
-    if self.subdomain and domain.count('.') == 1:
-      domain = f'{self.subdomain}.{domain}'
-
-    scheme = self.scheme or parsed.scheme
-    query = parsed.query if self.query else ''
-    fragment = parsed.fragment if self.fragment else ''
-
-    path = parsed.path
-    if self.trailing_slash and not path.endswith('/'):
-      path += '/'
-    elif not self.trailing_slash and path.endswith('/'):
-      path = path[:-1]
-
-    new_url = urllib.parse.urlunparse((scheme, domain, path, '', query, fragment))
-    if new_url != url:
-      return self(new_url, redirects=redirects)  # recheck approve/reject
-
-    if redirects or (redirects is None and self.redirects):
-      resp = follow_redirects(url, headers=self.headers)
-      if resp.status_code // 100 in (4, 5):
+    while True:
+      if self._approve and self._approve(url):
+        return url
+      elif self._reject and self._reject(url):
         return None
-      elif resp.url != url:
-        return self(resp.url, redirects=False)
 
-    return url
+      if not self._is_canonical(url):
+        parsed = _urlsplit(url)
+        domain = parsed.hostname
+        if not domain:
+          return None
+        elif (self.domain and domain != self.domain
+              and not domain.endswith(self._domain_suffix)):
+          return None
+        if domain.startswith('www.'):
+          domain = domain[4:]
+        if self.subdomain and domain.count('.') == 1:
+          domain = f'{self.subdomain}.{domain}'
+
+        scheme = self.scheme or parsed.scheme
+        query = parsed.query if self.query else ''
+        fragment = parsed.fragment if self.fragment else ''
+
+        path = parsed.path
+        if ';' in path:
+          # drop params from the last path segment, like urlparse does
+          params = path.find(';', max(path.rfind('/'), 0))
+          if params >= 0:
+            path = path[:params]
+        has_slash = path.endswith('/')
+        if self.trailing_slash and not has_slash:
+          path += '/'
+        elif has_slash and not self.trailing_slash:
+          path = path[:-1]
+
+        new_url = urllib.parse.urlunsplit((scheme, domain, path, query, fragment))
+        if new_url != url:
+          url = new_url
+          continue  # recheck approve/reject
+
+      if redirects or (redirects is None and self.redirects):
+        resp = follow_redirects(url, headers=self.headers)
+        if resp.status_code // 100 in (4, 5):
+          return None
+        elif resp.url != url:
+          url = resp.url
+          redirects = False
+          continue
+
+      return url
 
 
 class WideUnicode(str):
@@ -2014,28 +2383,15 @@ class WideUnicode(str):
   * http://stackoverflow.com/questions/1446347/how-to-find-out-if-python-is-compiled-with-ucs-2-or-ucs-4
   * http://stackoverflow.com/questions/12907022/python-getting-correct-string-length-when-it-contains-surrogate-pairs
   * http://stackoverflow.com/questions/35404144/correctly-extract-emojis-from-a-unicode-string
-  """
-  def __init__(self, *args, **kwargs):
-    super(WideUnicode, self).__init__()
-    # use UTF-32LE to avoid a byte order marker at the beginning of the string
-    self.__utf32le = str(self).encode('utf-32le')
-
-  def __len__(self):
-    return len(self.__utf32le) // 4
 
+  Python 3.3+ strings always index by code point (PEP 393), so this no longer
+  needs its own UTF-32 buffer. It just delegates to :class:`str` and keeps
+  returning :class:`WideUnicode` from indexing and slicing.
+  """
   def __getitem__(self, key):
-    length = len(self)
-
-    if isinstance(key, int):
-      if key >= length:
-        raise IndexError()
-      key = slice(key, key + 1)
-
-    start = key.start or 0
-    stop = length if key.stop is None else key.stop
-    assert key.step is None
-
-    return WideUnicode(self.__utf32le[start * 4:stop * 4].decode('utf-32le'))
+    if isinstance(key, slice):
+      assert key.step is None
+    return WideUnicode(super(WideUnicode, self).__getitem__(key))
 
   def __getslice__(self, i, j):
     return self.__getitem__(slice(i, j))
@@ -2067,22 +2423,66 @@ def parse_html(input, **kwargs):
   kwargs.setdefault('features', beautifulsoup_parser)
 
   if isinstance(input, requests.Response):
-    # The original HTTP 1.1 spec (RFC 2616, 1999) said to default HTML charset
-    # to ISO-8859-1 if it's not explicitly provided in Content-Type. RFC 7231
-    # (2014) removed that default: https://tools.ietf.org/html/rfc7231#appendix-B
-    #
-    # requests is working on incorporating that change, but hasn't shipped it yet.
-    # https://github.com/psf/requests/issues/2086
-    #
-    # so, if charset isn't explicitly provided, pass on the raw bytes and let
-    # BS4/UnicodeDammit figure it out from <meta charset> tag or anything else.
-    # https://github.com/snarfed/granary/issues/171
-    content_type = input.headers.get('content-type') or ''
-    input = input.text if 'charset' in content_type else input.content
+    input = _response_html(input)
+
+  return _beautifulsoup(input, kwargs)
+
+
+_bs_builders = threading.local()
+
+def _beautifulsoup(input, kwargs):
+  """Parses with a per-thread, reused tree builder when only features is set."""
+  features = kwargs['features']
+  if len(kwargs) == 1 and (features is None or isinstance(features, str)):
+    builders = _bs_builders.__dict__
+    builder = builders.get(features)
+    if not builder:
+      cls = bs4.builder.builder_registry.lookup(*filter(None, [features]))
+      if cls:
+        builder = builders[features] = cls()
+    if builder:
+      return bs4.BeautifulSoup(input, builder=builder)
 
   return bs4.BeautifulSoup(input, **kwargs)
 
 
+def _parse_response(resp):
+  """Parses a response with :func:`parse_html` and caches the soup on it.
+
+  Only for internal callers that don't modify the soup, eg
+  :func:`fetch_http_equiv` and then :func:`parse_mf2` on the same response.
+  :func:`parse_html` itself always returns a new soup.
+  """
+  if soup := _cached_soup(resp):
+    return soup
+  soup = parse_html(resp)
+  resp._webutil_soup = (beautifulsoup_parser, soup)
+  return soup
+
+
+def _cached_soup(resp):
+  """Returns the soup cached on a response by :func:`_parse_response`, or None."""
+  cached = getattr(resp, '_webutil_soup', None)
+  if cached and cached[0] == beautifulsoup_parser:
+    return cached[1]
+
+
+def _response_html(resp):
+  """Returns a :class:`requests.Response`'s body as str or bytes for parsing."""
+  # The original HTTP 1.1 spec (RFC 2616, 1999) said to default HTML charset
+  # to ISO-8859-1 if it's not explicitly provided in Content-Type. RFC 7231
+  # (2014) removed that default: https://tools.ietf.org/html/rfc7231#appendix-B
+  #
+  # requests is working on incorporating that change, but hasn't shipped it yet.
+  # https://github.com/psf/requests/issues/2086
+  #
+  # so, if charset isn't explicitly provided, pass on the raw bytes and let
+  # BS4/UnicodeDammit figure it out from <meta charset> tag or anything else.
+  # https://github.com/snarfed/granary/issues/171
+  content_type = resp.headers.get('content-type') or ''
+  return resp.text if 'charset' in content_type else resp.content
+
+
 def parse_mf2(input, url=None, id=None, metaformats=None):
   """Parses microformats2 out of HTML.
 
@@ -2102,11 +2502,17 @@ def parse_mf2(input, url=None, id=None, metaformats=None):
     dict: parsed mf2 data, or ``None`` if id is provided and not found in the
       input HTML
   """
-  if isinstance(input, requests.Response) and not url:
-    url = input.url
+  if isinstance(input, requests.Response):
+    if not url:
+      url = input.url
+    input = _cached_soup(input) or _response_html(input)
 
   if not isinstance(input, (bs4.BeautifulSoup, bs4.Tag)):
-    input = parse_html(input)
+    if id and beautifulsoup_parser != 'html5lib':  # html5lib ignores parse_only
+      # only build BeautifulSoup objects for the element we want
+      input = parse_html(input, parse_only=bs4.SoupStrainer(id=id))
+    else:
+      input = parse_html(input)
 
   if id:
     logger.info(f'Extracting and parsing just DOM element {id}')
@@ -2115,7 +2521,7 @@ def parse_mf2(input, url=None, id=None, metaformats=None):
       return None
 
   mf2 = mf2py.parse(url=url, doc=input)
-  if urlparse(url).path in ('', '/'):
+  if _urlsplit(url).path in ('', '/'):
     type = 'h-card'
     mf2_item = mf2util.representative_hcard(mf2, mf2.get('url') or url)
   else:
@@ -2145,6 +2551,8 @@ def parse_mf2(input, url=None, id=None, metaformats=None):
   return mf2
 
 
+_NON_EMPTY_RE = re.compile('.+')
+
 def parse_metaformats(soup, url, type='h-card'):
   """Converts metadata in an HTML page to a microformats2 item.
 
@@ -2209,7 +2617,7 @@ def parse_metaformats(soup, url, type='h-card'):
 
     # rel-icon is generally site-wide, not per page
     if type == 'h-card':
-      icons = soup.head.find_all('link', rel='icon', href=re.compile('.+'))
+      icons = soup.head.find_all('link', rel='icon', href=_NON_EMPTY_RE)
       if icons:
         urls_by_size = [urljoin(base, i['href'])
                         for i in sorted(icons, key=max_size, reverse=True)]
@@ -2239,12 +2647,18 @@ def parse_http_equiv(content):
   Returns:
     str: empty if content format is incorrect
   """
-  split = content.rpartition('URL=')
-  if not split[1]: # If URL= is not in the string return an empty string
+  idx = content.rfind('URL=')
+  if idx == -1: # If URL= is not in the string return an empty string
     return ''
 
-  return split[2].strip("'")
+  return content[idx + 4:].strip("'")
+
 
+_HTTP_EQUIV_REFRESH_RE = re.compile(r'http-equiv\s*=\s*["\']?refresh', re.I)
+_HTTP_EQUIV_REFRESH_BYTES_RE = re.compile(_HTTP_EQUIV_REFRESH_RE.pattern.encode(),
+                                          re.I)
+_META_REFRESH_XPATH = (lxml.etree.XPath('//meta[@http-equiv="refresh"]')
+                       if lxml else None)
 
 def fetch_http_equiv(input, **kwargs):
   """Fetches http_equiv meta tag, if available.
@@ -2255,8 +2669,42 @@ def fetch_http_equiv(input, **kwargs):
   Returns:
     str: empty if not available or a url if available
   """
+  resp = None
+  if isinstance(input, requests.Response):
+    resp = input
+    input = _cached_soup(resp) or _response_html(resp)
+
+  # most pages don't have a meta refresh, so check for one before parsing
+  if isinstance(input, str):
+    if not _HTTP_EQUIV_REFRESH_RE.search(input):
+      return ''
+  elif isinstance(input, bytes):
+    if not _HTTP_EQUIV_REFRESH_BYTES_RE.search(input):
+      return ''
+
+  if lxml and isinstance(input, bytes):
+    # lxml assumes Latin-1 when there's no declared charset, so detect the
+    # encoding the same way BeautifulSoup does
+    # https://github.com/snarfed/granary/issues/171
+    input = bs4.dammit.UnicodeDammit(input, is_html=True).unicode_markup or input
+
+  if lxml and isinstance(input, str):
+    # skip BeautifulSoup and search lxml's C tree directly
+    try:
+      tree = lxml.html.fromstring(input)
+    except (lxml.etree.ParserError, ValueError):
+      # empty document, or str with an XML encoding declaration
+      tree = None
+
+    # fromstring returns a comment or processing instruction, not an element,
+    # for some fragments. fall back to BeautifulSoup for those.
+    if isinstance(tree, lxml.html.HtmlElement):
+      elements = _META_REFRESH_XPATH(tree)
+      refresh_content = elements[0].get('content') if elements else None
+      return parse_http_equiv(refresh_content) if refresh_content else ''
+
   if not isinstance(input, (bs4.BeautifulSoup, bs4.Tag)):
-    input = parse_html(input)
+    input = _parse_response(resp) if resp else parse_html(input)
 
   element = input.find('meta', attrs={'http-equiv': 'refresh'})
 
@@ -2305,14 +2753,15 @@ def fetch_mf2(url, get_fn=requests_get, gateway=False, require_backlink=None,
   if require_backlink:
     if not isinstance(require_backlink, (tuple, list)):
       require_backlink = [require_backlink]
-    for link in require_backlink:
-      if link in resp.text:
-        break
-    else:
-      raise ValueError(f"Couldn't find {require_backlink} in {url}")
-
-  parsed = urlparse(url)
-  fragment = parsed.fragment
+    # scan the raw bytes first so we usually don't have to decode the body. fall
+    # back to the decoded text for non-UTF-8 pages.
+    body = resp.content
+    if not any(link.encode() in body for link in require_backlink):
+      text = resp.text
+      if not any(link in text for link in require_backlink):
+        raise ValueError(f"Couldn't find {require_backlink} in {url}")
+
+  fragment = url.partition('#')[2]
   mf2 = parse_mf2(resp, id=fragment, metaformats=metaformats)
 
   if not mf2:
@@ -2377,4 +2826,5 @@ def d(*objs):
 
     dumped.append(str(o))
 
-  print('@', inspect.stack()[1].function, ' '.join(dumped))
+  # inspect.stack() reads source context for every frame, just get the caller
+  print('@', inspect.currentframe().f_back.f_code.co_name, ' '.join(dumped))